@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import gc
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+import life
+import lifegen
+
+###############################################################################
+#############################  LIFE benchmarks  ###############################
+###############################################################################
+# Times the main operations of life.py on a synthetic corpus (see lifegen.py)  #
+# and reports throughput and peak memory. Results can be saved and compared   #
+# with a previous run, to catch performance regressions.                      #
+###############################################################################
+
+
+def load(path, lazy=False):
+    return life.Life(path, lazy=lazy)
+
+
+BENCHMARKS = [
+    # name, function of the loaded Life (None to time loading the file)
+    ("from_file",          None),
+    ("from_file_lazy",     None),
+    ("when_at",            lambda l: l.when_at("restaurant")),
+    ("total_at",           lambda l: l.total_at("home")),
+    ("with_tag",           lambda l: l.with_tag("lunch")),
+    ("query",              lambda l: l.query().tag("lunch").weekdays(0, 1, 2, 3, 4).after("1200").count()),
+    ("time_at_all_places", lambda l: l.time_at_all_places()),
+    ("time_near",          lambda l: l.time_near("home", 2)),
+    ("to_json",            lambda l: l.to_json()),
+    ("repr",               lambda l: repr(l)),
+]
+
+
+def measure(function, repeat):
+    """Best time (in seconds) of 'repeat' calls, and the peak memory (in
+    bytes) allocated by one call"""
+    best = None
+    for i in range(repeat):
+        gc.collect()
+        t = time.perf_counter()
+        function()
+        t = time.perf_counter() - t
+        best = t if best is None or t < best else best
+    gc.collect()
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def run(path, repeat=3, only=None):
+    """Runs the benchmarks on the LIFE file at 'path'. Returns a dictionary
+    name -> {"seconds", "spans_per_second", "peak_bytes"}"""
+    results = {}
+    directory, filename = os.path.split(os.path.abspath(path))
+    cwd = os.getcwd()
+    os.chdir(directory)          # included files are relative to the main one
+    try:
+        l = load(filename)
+        spans = sum([len(d.spans) for d in l.days])
+        for name, function in BENCHMARKS:
+            if only and not name in only:
+                continue
+            if function is None:
+                lazy = name.endswith("_lazy")
+                seconds, peak = measure(lambda: load(filename, lazy), repeat)
+            else:
+                function(l)      # warm up lazily built indexes
+                seconds, peak = measure(lambda: function(l), repeat)
+            results[name] = {"seconds": seconds,
+                             "spans_per_second": spans/seconds if seconds else 0,
+                             "peak_bytes": peak}
+    finally:
+        os.chdir(cwd)
+    return results
+
+
+def profile(path):
+    """Loads the LIFE file at 'path' with profiling on, runs each benchmark
+    once and returns the report (see life.Profile)"""
+    directory, filename = os.path.split(os.path.abspath(path))
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        l = life.Life(filename, profile=True)
+        for name, function in BENCHMARKS:
+            if function is not None:
+                function(l)
+        return l._profile.report()
+    finally:
+        os.chdir(cwd)
+
+
+def report(results, baseline=None, threshold=0.2):
+    """Prints the results (and their change relative to a baseline). Returns
+    the names of the benchmarks that got slower by more than 'threshold'."""
+    regressions = []
+    print("%-20s %12s %16s %12s %10s" % ("benchmark", "ms", "spans/s", "peak KiB", "change"))
+    for name, r in results.items():
+        change = ""
+        if baseline and name in baseline:
+            ratio = r["seconds"]/baseline[name]["seconds"] - 1
+            change = "%+.0f%%" % (ratio*100)
+            if ratio > threshold:
+                regressions.append(name)
+                change += " !"
+        print("%-20s %12.2f %16.0f %12.0f %10s" % (name, r["seconds"]*1000, r["spans_per_second"],
+                                                   r["peak_bytes"]/1024, change))
+    return regressions
+
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks life.py on a synthetic corpus")
+    parser.add_argument("--file", help="benchmark an existing LIFE file instead of a synthetic one")
+    parser.add_argument("--years", type=float, default=10)
+    parser.add_argument("--places", type=int, default=200)
+    parser.add_argument("--includes", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", nargs="*", help="names of the benchmarks to run")
+    parser.add_argument("--save", help="save the results (JSON) to this file")
+    parser.add_argument("--compare", help="compare with results saved by a previous run")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="slowdown (fraction) reported as a regression")
+    parser.add_argument("--profile", action="store_true",
+                        help="also print the time spent in each parse phase and query")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.file
+        if not path:
+            path = os.path.join(tmp, "bench.life")
+            lifegen.generate(path, years=args.years, places=args.places,
+                             includes=args.includes, seed=args.seed)
+        results = run(path, args.repeat, args.only)
+        if args.profile:
+            print(profile(path)+"\n")
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf8") as f:
+            baseline = json.load(f)
+    regressions = report(results, baseline, args.threshold)
+    if args.save:
+        with open(args.save, "w", encoding="utf8") as f:
+            json.dump(results, f, indent=1)
+    if regressions:
+        print("regressions:", ", ".join(regressions))
+        sys.exit(1)
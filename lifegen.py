@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+import os
+import random
+import datetime
+import argparse
+
+###############################################################################
+#########################  Synthetic LIFE generator  ##########################
+###############################################################################
+# Writes deterministic, realistic-looking LIFE files (routines, trips abroad,  #
+# place hierarchies, tags with values, semantics, name changes, includes),   #
+# for testing and benchmarking life.py on archives of any size.               #
+###############################################################################
+
+
+MOVIES = ["star wars: the force awakens", "deadpool", "inside out", "the martian",
+          "mad max: fury road", "arrival", "moonlight", "la la land", "dunkirk",
+          "coco", "roma", "parasite", "joker", "soul", "dune"]
+FOODS = ["chicken", "french fries", "salad", "beef", "fish", "rice", "pasta",
+         "soup", "pizza", "burger", "sushi", "tofu"]
+PEOPLE = ["jack", "mary", "sam", "alex", "kim", "lee", "ana", "rui", "joão"]
+REASONS = ["meeting with %s", "%s's birthday", "dinner with %s", "coffee with %s",
+           "helping %s move", "%s's retirement party"]
+TIMEZONES = [-5, -3, 1, 2, 3, 8, 9]
+
+
+def military(minutes):
+    """Converts minutes since the day began to 'military format' ('1243')"""
+    return "%02d%02d" % (minutes // 60, minutes % 60)
+
+
+class Generator:
+    """Generates a synthetic life. The result only depends on the parameters
+    (and 'seed'):
+
+    years               number of years of daily records
+    places              number of distinct places (besides home and work)
+    depth               depth of the place hierarchy (@sub<super), 0 for none
+    tag_density         probability of a span having tags
+    semantics_density   probability of a span having semantics
+    timezone_changes    number of trips abroad (changing timezone)
+    includes            number of files the days are split into (0 for a
+                        single file)
+    nameswaps           number of places that change names (@old>>new)
+    """
+    def __init__(self, years=1, places=50, depth=2, tag_density=0.3,
+                 semantics_density=0.1, timezone_changes=4, includes=0,
+                 nameswaps=5, seed=0, start=datetime.date(2000, 1, 1)):
+        self.rnd = random.Random(seed)
+        self.years = years
+        self.depth = depth
+        self.tag_density = tag_density
+        self.semantics_density = semantics_density
+        self.includes = includes
+        self.start = start
+        self.ndays = int(round(years*365.25))
+        self.timezone = 0
+        self._make_places(places)
+        self._make_trips(timezone_changes)
+        self._make_nameswaps(nameswaps)
+
+
+    def _make_places(self, n):
+        rnd = self.rnd
+        kinds = [("restaurant", 0.35), ("shop", 0.25), ("cinema", 0.05),
+                 ("gym", 0.05), ("friend's home", 0.1), ("park", 0.1),
+                 ("mall", 0.1)]
+        self.places = {"home": "home", "work": "work"}   # name -> kind
+        self.bykind = {}
+        for i in range(n):
+            r = rnd.random()
+            for kind, p in kinds:
+                r -= p
+                if r <= 0:
+                    break
+            name = "%s %d" % (kind, i)
+            self.places[name] = kind
+            self.bykind.setdefault(kind, []).append(name)
+        # place hierarchy: malls contain shops and restaurants, which may in
+        # turn contain other places, down to 'depth' levels
+        self.superplaces = {}
+        if self.depth > 0:
+            level = self.bykind.get("mall", [])
+            inner = [p for p in self.places if self.places[p] in ("shop", "restaurant", "cinema")]
+            for d in range(self.depth):
+                nxt = []
+                for p in inner:
+                    if level and rnd.random() < 0.5 and not p in self.superplaces and not p in level:
+                        self.superplaces[p] = rnd.choice(level)
+                        nxt.append(p)
+                level = nxt
+                inner = [p for p in inner if not p in self.superplaces]
+        self.coordinates = {}
+        for p in self.places:
+            self.coordinates[p] = (38.7 + rnd.uniform(-0.2, 0.2), -9.1 + rnd.uniform(-0.2, 0.2))
+
+
+    def _make_trips(self, n):
+        """Trips abroad: (first day, last day, offset)"""
+        rnd = self.rnd
+        self.trips = []
+        if n == 0 or self.ndays < 10:
+            return
+        starts = sorted(rnd.sample(range(1, self.ndays-5), min(n, self.ndays//10)))
+        last = 0
+        for s in starts:
+            if s <= last:
+                continue
+            length = rnd.randint(2, 6)
+            self.trips.append((s, min(s+length, self.ndays-1), rnd.choice(TIMEZONES)))
+            last = s+length+1
+
+
+    def _make_nameswaps(self, n):
+        """Places that change names: day -> (old, new)"""
+        rnd = self.rnd
+        self.nameswaps = {}
+        candidates = [p for p in self.places if self.places[p] in ("restaurant", "shop")]
+        for i in range(min(n, len(candidates))):
+            p = candidates.pop(rnd.randrange(len(candidates)))
+            self.nameswaps[rnd.randrange(self.ndays)] = (p, "new %s" % p)
+
+
+    def _tags(self, kind, hour):
+        rnd = self.rnd
+        tags = []
+        if kind == "restaurant" or kind == "home" and hour >= 19*60:
+            meal = "lunch" if hour < 16*60 else "dinner"
+            if rnd.random() < 0.5:
+                meal += ":" + ",".join(rnd.sample(FOODS, rnd.randint(1, 2)))
+            tags.append(meal)
+        if kind == "cinema":
+            tags.append("movies:" + rnd.choice(MOVIES))
+        if rnd.random() < self.tag_density:
+            tags.append(rnd.choice(["leisure", "family", "work", "sport", "reading", "water:33cl"]))
+        return "|".join(tags)
+
+
+    def _span(self, start, end, place, tags="", semantics=""):
+        line = "%s-%s: %s" % (military(start), military(end), place)
+        if tags:
+            line += " [%s]" % tags
+        if semantics:
+            line += " {%s}" % semantics
+        return line
+
+
+    def _describe(self, start, end, place, kind):
+        rnd = self.rnd
+        tags = self._tags(kind, start) if rnd.random() < self.tag_density or kind in ("restaurant", "cinema") else ""
+        semantics = ""
+        if rnd.random() < self.semantics_density:
+            semantics = rnd.choice(REASONS) % rnd.choice(PEOPLE)
+        return self._span(start, end, place, tags, semantics)
+
+
+    def day(self, n, names):
+        """Lines for day number 'n'. 'names' maps places to their current names"""
+        rnd = self.rnd
+        date = self.start + datetime.timedelta(days=n)
+        lines = ["--%04d_%02d_%02d" % (date.year, date.month, date.day)]
+        if n == 0:
+            lines.append("UTC")
+        if n in self.nameswaps:
+            old, new = self.nameswaps[n]
+            lines.append("@%s>>%s" % (old, new))
+        trip = [t for t in self.trips if t[0] <= n <= t[1]]
+        if trip and (n == trip[0][0] or n == trip[0][1]):
+            # flying out or back: the arrival is in another timezone
+            first, last, offset = trip[0]
+            going = n == first
+            dest = offset if going else 0
+            t = rnd.randint(6*60, 9*60)
+            lines.append(self._span(0, t, "home" if going else "hotel"))
+            lines.append(self._span(t, t+40, "home->airport" if going else "hotel->airport", "taxi"))
+            t += 40
+            lines.append(self._span(t, t+90, "airport"))
+            t += 90
+            arrive = min(t + 180 + (dest - self.timezone)*60, 23*60)
+            arrive = max(arrive, t+1)
+            lines.append(("@UTC%+d" % dest) if dest else "@UTC")
+            lines.append(self._span(t, arrive, "airport->foreign airport" if going else "foreign airport->airport", "plane"))
+            self.timezone = dest
+            lines.append(self._span(arrive, min(arrive+60, 1438), "foreign airport" if going else "airport"))
+            lines.append(self._span(min(arrive+90, 1438), 1439, "hotel" if going else "home", "dinner"))
+            return lines
+        if trip:
+            lines.append(self._span(0, 480, "hotel"))
+            lines.append(self._describe(540, 1020, "client office", "work"))
+            lines.append(self._describe(1100, 1439, "hotel", "home"))
+            return lines
+        t = 0
+        weekend = date.weekday() >= 5
+        wake = rnd.randint(6*60+30, 8*60+30) + (90 if weekend else 0)
+        lines.append(self._span(0, wake, "home"))
+        t = wake + rnd.randint(15, 45)
+        others = [p for p in self.places if p not in ("home", "work")]
+        plan = []
+        if not weekend:
+            plan.append(("work", rnd.randint(12*60, 13*60)))
+            if others:
+                plan.append((rnd.choice(self.bykind.get("restaurant", others)), rnd.randint(45, 80)))
+            plan.append(("work", rnd.randint(17*60+30, 19*60)))
+        for i in range(rnd.randint(0, 3)):
+            if others:
+                plan.append((rnd.choice(others), rnd.randint(20, 150)))
+        prev = "home"
+        for place, until in plan:
+            if t >= 22*60:
+                break
+            end = until if until > t and until > 600 else t + until
+            end = min(end, 22*60)
+            if end <= t:
+                continue
+            if rnd.random() < 0.15:
+                lines.append(self._span(t-10, t, "%s->%s" % (names.get(prev, prev), names.get(place, place)),
+                                        rnd.choice(["walk", "bus", "bus:767", "car", "subway"])))
+            lines.append(self._describe(t, end, names.get(place, place), self.places.get(place, "")))
+            prev = place
+            t = end + rnd.randint(10, 40)
+        if t < 1439:
+            lines.append(self._describe(min(t, 1438), 1439, "home", "home"))
+        if rnd.random() < 0.05:
+            lines.append("> water:%.1f|km:%.1f" % (rnd.uniform(1, 3), rnd.uniform(1, 15)))
+        return lines
+
+
+    def meta(self):
+        """Lines with the global meta-commands (hierarchy, categories, locations)"""
+        lines = ["; places"]
+        for p, s in sorted(self.superplaces.items()):
+            lines.append("@%s<%s" % (p, s))
+        for p, kind in sorted(self.places.items()):
+            lines.append("@%s:%s" % (p, kind))
+        for p, (lat, lon) in sorted(self.coordinates.items()):
+            lines.append("@%s @ %.6f,%.6f" % (p, lat, lon))
+        return lines
+
+
+    def write(self, path):
+        """Writes the life to 'path' (and to included files next to it, if
+        'includes' > 0). Returns the list of files written."""
+        base, ext = os.path.splitext(path)
+        files = [path]
+        names = {}
+        days = []
+        for n in range(self.ndays):
+            days.append(self.day(n, names))
+            if n in self.nameswaps:
+                old, new = self.nameswaps[n]
+                names[old] = new
+        with open(path, "w", encoding="utf8") as f:
+            f.write("; synthetic LIFE file, generated by lifegen.py\n")
+            if self.includes > 0:
+                metafile = base+"-places"+ext
+                self._write_lines(metafile, self.meta())
+                files.append(metafile)
+                f.write('@include "%s"\n' % os.path.basename(metafile))
+                size = len(days)//self.includes + 1
+                for i in range(self.includes):
+                    part = days[i*size:(i+1)*size]
+                    if not part:
+                        break
+                    name = "%s-%d%s" % (base, i+1, ext)
+                    self._write_lines(name, [l for d in part for l in d])
+                    files.append(name)
+                    f.write('@include "%s"\n' % os.path.basename(name))
+            else:
+                f.write("\n".join(self.meta())+"\n\n")
+                for d in days:
+                    f.write("\n".join(d)+"\n\n")
+        return files
+
+
+    def _write_lines(self, path, lines):
+        with open(path, "w", encoding="utf8") as f:
+            f.write("\n".join(lines)+"\n")
+
+
+
+def generate(path, **params):
+    """Writes a synthetic LIFE file to 'path' (see Generator for the
+    parameters). Returns the list of files written."""
+    return Generator(**params).write(path)
+
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Generates a synthetic LIFE file")
+    parser.add_argument("path")
+    parser.add_argument("--years", type=float, default=1)
+    parser.add_argument("--places", type=int, default=50)
+    parser.add_argument("--depth", type=int, default=2)
+    parser.add_argument("--tag-density", type=float, default=0.3)
+    parser.add_argument("--semantics-density", type=float, default=0.1)
+    parser.add_argument("--timezone-changes", type=int, default=4)
+    parser.add_argument("--includes", type=int, default=0)
+    parser.add_argument("--nameswaps", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    for f in generate(args.path, years=args.years, places=args.places, depth=args.depth,
+                      tag_density=args.tag_density, semantics_density=args.semantics_density,
+                      timezone_changes=args.timezone_changes, includes=args.includes,
+                      nameswaps=args.nameswaps, seed=args.seed):
+        print(f)
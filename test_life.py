@@ -0,0 +1,390 @@
+"""Parity tests: parse_description must give the same place, tags, semantics
+and tag values as the original per-character Span.parse_place (and the trip
+split in Span.__init__), frozen below; and the other ways of loading a LIFE
+file must give the same days and meta-commands as a plain, eager parse.
+
+Run with: python -m unittest test_life  (or pytest)"""
+
+import itertools
+import os
+import random
+import sys
+import tempfile
+import unittest
+
+import life
+import lifegen
+
+
+def old_parse_description(to_parse):
+    """Span.parse_place and the trip split of Span.__init__, as they were
+    before tokenize_place, returning (place, tags, semantics, tagvalues)"""
+    acc=""
+    context = ""
+    tags=""
+    semantics=""
+    place=""
+    for c in to_parse:
+        if c=="[":
+            if acc:
+                if context=="":
+                    place=acc
+                acc=""
+            context = "["
+        elif c=="{":
+            if acc:
+                if context=="":
+                    place=acc
+                acc=""
+            context = "{"
+        elif c=="]":
+            if context=="[":
+                tags=acc
+                context="."
+                acc=""
+            else:
+                acc=acc+c
+        elif c=="}":
+            if context=="{":
+                semantics=acc
+                context="."
+                acc=""
+            else:
+                acc=acc+c
+        else:
+            acc=acc+c
+    if acc:
+        place=acc
+    tags, tagvalues = life.tag_lists(tags)
+    if semantics=="":
+        semantics=()
+    else:
+        semantics=tuple([sys.intern(x.strip()) for x in semantics.split("|")])
+    place = sys.intern(place.strip())
+    if "->" in place:
+        place=(sys.intern(place.split("->")[0].strip()),sys.intern(place.split("->")[1].strip()))
+    return place, tags, semantics, tagvalues
+
+
+def descriptions(path):
+    """The span descriptions in a .life file, as the parser sees them"""
+    res = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.partition(";")[0].strip().lower()
+            if line and line[0] in "0123456789":
+                res.append(line[line.find(":")+1:].strip())
+    return res
+
+
+META = ("categories", "placecategories", "subplaces", "superplaces", "nameswaps",
+        "locationswaps", "swaps", "coordinates")
+
+def state(l):
+    """Everything parsed into a Life, in comparable form"""
+    days = [(d.date, d.notes, [(s.day, s.start, s.end, s.place, s.tags, s.semantics, s.tagvalues,
+                                s.start_timezone, s.end_timezone, s.start_epoch, s.end_epoch)
+                               for s in d.spans]) for d in l.days]
+    return days, [getattr(l, m) for m in META]
+
+
+def generate(tmp, name, **params):
+    """Path of a generated LIFE file in 'tmp' (2 years, with timezone changes)"""
+    params = dict(dict(years=2, timezone_changes=12, tag_density=0.5, semantics_density=0.2,
+                       nameswaps=4, seed=len(name)), **params)
+    return lifegen.generate(os.path.join(tmp, name), **params)[0]
+
+
+
+class ParseDescriptionParity(unittest.TestCase):
+
+    def check(self, texts):
+        for text in texts:
+            self.assertEqual(life.parse_description(text), old_parse_description(text), repr(text))
+
+
+    def test_examples(self):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples.life")
+        texts = descriptions(path)
+        self.assertTrue(texts)
+        self.check(texts)
+
+
+    def test_generated(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            texts = []
+            for path in lifegen.generate(os.path.join(tmp, "gen.life"), years=2, includes=2,
+                                         tag_density=0.5, semantics_density=0.3, seed=1):
+                texts.extend(descriptions(path))
+        self.assertTrue(texts)
+        self.check(set(texts))
+
+
+    def test_short_strings(self):
+        alphabet = "ab []{}|:->"
+        self.check(["".join(t) for n in range(5) for t in itertools.product(alphabet, repeat=n)])
+
+
+    def test_random_strings(self):
+        rnd = random.Random(0)
+        alphabet = "ab ,[]{}|:->"
+        self.check(["".join([rnd.choice(alphabet) for i in range(rnd.randint(5, 20))]) for j in range(20000)])
+
+
+
+
+class CategoryTimeline(unittest.TestCase):
+    """Category commands apply from the day they appear on (see README)"""
+
+    def test_category_at(self):
+        l = life.Life()
+        l.from_string("@bar:pub\n"
+                      "--2020_01_01\n0000-0100: cafe\n0100-0200: bar\n"
+                      "--2020_01_05\n@cafe:restaurant\n0000-0100: cafe\n"
+                      "--2020_01_09\n@cafe:work\n0000-0300: cafe\n")
+        self.assertEqual(l.category_at("cafe", "2020_01_01"), None)
+        self.assertEqual(l.category_at("cafe", "2020_01_05"), "restaurant")
+        self.assertEqual(l.category_at("cafe", "2020_01_08"), "restaurant")
+        self.assertEqual(l.category_at("cafe", "2020_01_10"), "work")
+        self.assertEqual(l.category_at("bar", "1999_01_01"), "pub")     # (before any day)
+        totals = {None: 60, "pub": 60, "restaurant": 60, "work": 180}
+        self.assertEqual(l.time_by_category(), totals)
+        self.assertEqual(l.rollup().totals("category"), totals)
+        self.assertEqual(l.query().category("restaurant").count(), 1)
+
+
+
+class RollupParity(unittest.TestCase):
+    """Rollup totals against sums over the spans, as days change"""
+
+    def brute(self, l, dimension, start, end):
+        tops = l.hierarchy().tops
+        res = {}
+        for d in l.days:
+            if not start <= d.date <= end:
+                continue
+            for s in d.spans:
+                if dimension == "tag":
+                    keys = dict.fromkeys([name for name, values in s.tagvalues])
+                elif type(s.place) == tuple:
+                    continue
+                elif dimension == "place":
+                    keys = [s.place]
+                elif dimension == "superplace":
+                    keys = [tops.get(s.place, s.place)]
+                else:
+                    keys = [l.category_at(s.place, d.date)]
+                for k in keys:
+                    res[k] = res.get(k, 0) + s.end - s.start
+        return dict([(k, v) for k, v in res.items() if v])
+
+
+    def check(self, l, rnd):
+        rollup = l.rollup()
+        dates = sorted([d.date for d in l.days])
+        for i in range(10):
+            start, end = sorted([rnd.choice(dates), rnd.choice(dates)])
+            for dimension in life.Rollup.DIMENSIONS:
+                self.assertEqual(rollup.totals(dimension, start, end), self.brute(l, dimension, start, end),
+                                 (dimension, start, end))
+        for dimension in life.Rollup.DIMENSIONS:
+            self.assertEqual(rollup.totals(dimension), self.brute(l, dimension, "", "\U0010ffff"))
+
+
+    def test_rollup(self):
+        rnd = random.Random(0)
+        with tempfile.TemporaryDirectory() as tmp:
+            l = life.Life(generate(tmp, "single.life", years=1, depth=3))
+        self.check(l, rnd)
+        l.remove_day(l.days[100].date)
+        self.check(l, rnd)
+        date = l.days[50].date
+        l.update_day_from_string(date, "0000-0800: home [sleep]\n0900-1000: elsewhere [x:1]\n")
+        self.check(l, rnd)
+        l.from_string("--1999_12_01\n0000-1000: home [early]\n0000-0100: late\n"
+                      "--2099_01_01\n@late:pub\n0000-0100: late\n")
+        self.check(l, rnd)
+
+
+
+class RefreshParity(unittest.TestCase):
+    """refresh() after appending, and snapshot loads, against a full reload"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp.name)     # (includes are relative to the current directory)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+
+    def appending(self, path, cache=None):
+        """Writes 'path' back in steps, of whole lines (most steps end in the
+        middle of a day), checking a refreshed instance against a reload each
+        time"""
+        with open(path, encoding="utf8") as f:
+            text = f.read()
+        rnd = random.Random(0)
+        cuts = sorted(set([text.index("\n", i)+1 for i in rnd.sample(range(len(text)//3, len(text)-1), 12)] + [len(text)]))
+        done = text.index("\n", len(text)//3)+1
+        with open(path, "w", encoding="utf8") as f:
+            f.write(text[:done])
+        l = life.Life(path, cache=cache)
+        for cut in cuts:
+            with open(path, "a", encoding="utf8") as f:
+                f.write(text[done:cut])
+            done = cut
+            l.refresh()
+            self.assertEqual(state(l), state(life.Life(path)), cut)
+
+
+    def test_append(self):
+        self.appending(generate(self.tmp.name, "single.life"))
+
+
+    def test_append_snapshot(self):
+        path = generate(self.tmp.name, "single.life")
+        life.Life(path, cache=True)
+        self.appending(path, cache=True)
+
+
+    def test_append_tree(self):
+        path = generate(self.tmp.name, "tree.life", includes=2)
+        l = life.Life(path)
+        with open(path, "a", encoding="utf8") as f:
+            f.write("--2099_01_01\nutc+3\n0000-0100: home [x]\n@home:house\n")
+        l.refresh()
+        self.assertEqual(state(l), state(life.Life(path)))
+
+
+    def test_snapshot(self):
+        for path in (generate(self.tmp.name, "single.life"), generate(self.tmp.name, "tree.life", includes=2)):
+            eager = life.Life(path)
+            life.Life(path, cache=True)     # writes the snapshot
+            cached = life.Life()
+            self.assertTrue(cached.load_snapshot(path+".snapshot", path))
+            self.assertEqual(state(cached), state(eager))
+            self.assertEqual(state(life.Life(path, cache=True)), state(eager))
+
+
+
+class LazyParity(unittest.TestCase):
+    """lazy=True against eager parsing"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.single = generate(cls.tmp.name, "single.life")
+        cls.tree = generate(cls.tmp.name, "tree.life", includes=3)
+        cls.cwd = os.getcwd()
+        os.chdir(cls.tmp.name)      # (includes are relative to the current directory)
+
+    @classmethod
+    def tearDownClass(cls):
+        os.chdir(cls.cwd)
+        cls.tmp.cleanup()
+
+
+    def test_file(self):
+        for path in (self.single, self.tree):
+            eager = life.Life(path)
+            lazy = life.Life(path, lazy=True)
+            self.assertEqual(repr(lazy), repr(eager))
+            self.assertEqual(state(lazy), state(eager))
+
+
+    def test_string(self):
+        with open(self.single, encoding="utf8") as f:
+            text = f.read()
+        eager = life.Life()
+        eager.from_string(text)
+        for content in (text, text.split("\n"), text.splitlines(True)):
+            lazy = life.Life()
+            lazy.from_string(content, lazy=True)
+            self.assertEqual(state(lazy), state(eager))
+
+
+    def test_file_object(self):
+        eager = life.Life(self.single)
+        lazy = life.Life()
+        with open(self.single, encoding="utf8") as f:
+            lazy.from_string(f, lazy=True)
+        self.assertEqual(state(lazy), state(eager))
+
+
+    def test_partly_loaded(self):
+        eager = life.Life(self.single)
+        lazy = life.Life(self.single, lazy=True)
+        q = lazy.query().between(eager.days[10].date, eager.days[19].date)
+        self.assertEqual(q.count(), sum([len(d.spans) for d in eager.days[10:20]]))
+        self.assertEqual(sum([d.loaded() for d in lazy.days]), 10)
+        self.assertEqual(lazy.total_at("home"), eager.total_at("home"))
+        self.assertEqual(state(lazy), state(eager))
+
+
+
+
+class IndexedParity(unittest.TestCase):
+    """indexed=True (DayIndex and memory maps) against eager parsing"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp.name)     # (includes are relative to the current directory)
+        self.single = generate(self.tmp.name, "single.life")
+        self.tree = generate(self.tmp.name, "tree.life", includes=3)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+
+    def test_file(self):
+        for path in (self.single, self.tree):
+            eager = life.Life(path)
+            for i in range(2):      # building the index, then reusing it
+                with life.Life(path, indexed=True) as indexed:
+                    self.assertTrue(os.path.exists(path+".dayindex"))
+                    self.assertEqual(repr(indexed), repr(eager))
+                    self.assertEqual(state(indexed), state(eager))
+
+
+    def test_edited(self):
+        life.Life(self.single, indexed=True).close()
+        with open(self.single, "a", encoding="utf8") as f:
+            f.write("\n--2099_01_01\n0000-0100: home [x]\n")
+        eager = life.Life(self.single)
+        with life.Life(self.single, indexed=True) as indexed:
+            self.assertEqual(indexed.days[-1].date, "2099_01_01")
+            self.assertEqual(state(indexed), state(eager))
+
+
+    def test_changed_after_loading(self):
+        with open(self.single, "rb") as f:
+            data = f.read()
+        indexed = life.Life(self.single, indexed=True)
+        first = len(indexed.days[0].spans)
+        with open(self.single, "wb") as f:
+            f.write(data[:len(data)//2])
+        with self.assertRaises(ValueError):
+            indexed.days[-1].spans
+        with self.assertRaises(ValueError):     # (and the day is not taken as empty)
+            indexed.days[-1].spans
+        self.assertEqual(len(indexed.days[0].spans), first)
+        indexed.close()
+
+
+    def test_close(self):
+        indexed = life.Life(self.single, indexed=True)
+        spans = len(indexed.days[0].spans)
+        indexed.close()
+        self.assertEqual(len(indexed.days[0].spans), spans)
+        with self.assertRaises(ValueError):
+            indexed.days[1].spans
+
+
+
+if __name__ == "__main__":
+    unittest.main()